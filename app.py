@@ -1,40 +1,139 @@
 import os
+import argparse
+import asyncio
 import logging
+import logging.handlers
+import atexit
+import queue
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-import pickle
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError
 import base64
+import email
+import email.policy
 import time
+import random
+import signal
 from datetime import datetime
 import json
+import calendar
+import re
+import sqlite3
+import orjson
+import threading
+import functools
+import hmac
+import urllib.parse
+import httpx
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dateparser
+from dateparser.search import search_dates
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('email_processor.log'),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging: records are queued in memory and written to the file and
+# console by a background thread, keeping disk I/O off the event loop
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.handlers.RotatingFileHandler(
+        'email_processor.log', maxBytes=10 * 1024 * 1024, backupCount=5
+    ),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Attach the QueueHandler directly: basicConfig would give it a formatter too,
+# and records would be formatted twice
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+# Shared HTTP/2 client for Gmail, Sheets and OpenAI: connections are kept alive
+# and concurrent requests to the same host are multiplexed over one TLS session
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+# Shared OpenAI client; requests to it are capped at OPENAI_CONCURRENCY in flight
+OPENAI_CONCURRENCY = 8
+openai_client = AsyncOpenAI(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    max_retries=2,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    http_client=http_client
+)
+openai_semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+# OpenAI account limits, used to throttle requests before they hit a 429
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '200000'))
+OPENAI_MAX_TOKENS_PER_EMAIL = 100
+# Emails extracted together in a single chat completion request
+EXTRACTION_GROUP_SIZE = 8
+# After a 429, pause all requests this long (unless the server sends Retry-After),
+# then refill capacity at half rate for as long again
+RATE_LIMIT_COOLDOWN = 15
+RATE_LIMIT_RETRIES = 3
+# Reprocessing runs at least this large go through the (cheaper, slower) OpenAI Batch API
+BATCH_API_THRESHOLD = int(os.getenv('BATCH_API_THRESHOLD', '1000'))
+BATCH_POLL_INTERVAL = 60
+
 # Gmail API scope
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/spreadsheets']
 
+# Gmail watch expires after 7 days; renew it once it is within a day of expiring
+WATCH_RENEW_MARGIN = 24 * 60 * 60
+# Re-check history this often even when no notification arrives
+NOTIFICATION_TIMEOUT = 60 * 60
+GMAIL_API = 'https://gmail.googleapis.com/gmail/v1/users/me'
+SHEETS_API = 'https://sheets.googleapis.com/v4/spreadsheets'
+# Sent messages listed per poll
+GMAIL_PAGE_SIZE = 100
+# Gmail messages fetched at once
+GMAIL_CONCURRENCY = 10
+# Polling interval, plus up to POLL_JITTER seconds so restarts don't line up
+POLL_INTERVAL = 60
+POLL_JITTER = 5
+# Spreadsheet rows are buffered and written once this many are pending or the
+# oldest has waited this many seconds
+ROW_BUFFER_SIZE = 20
+ROW_FLUSH_INTERVAL = 10
+# While this many rows are waiting on a failing spreadsheet, no new emails are taken in
+MAX_BUFFERED_ROWS = 1000
+# Emails that fail are retried after min(MAX_RETRY_DELAY, 2 ** attempts) seconds
+MAX_RETRY_DELAY = 60 * 60
+RETRY_CHECK_INTERVAL = 30
+# After this many attempts an email is given up on and left in failures.db
+MAX_RETRY_ATTEMPTS = 10
+
+def atomic_write(path, content):
+    # Write to a temporary file first so a crash never leaves a half-written file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+@functools.lru_cache(maxsize=None)
 def get_google_credentials():
     creds = None
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
+    if os.path.exists('token.json'):
+        with open('token.json', 'r') as token:
+            creds = Credentials.from_authorized_user_info(json.load(token), SCOPES)
     
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -44,190 +143,1061 @@ def get_google_credentials():
                 'credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        atomic_write('token.json', creds.to_json())
     
     return creds
 
-def extract_email_data(email_content):
+google_token_lock = asyncio.Lock()
+
+async def google_request(method, url, **kwargs):
+    creds = get_google_credentials()
+    async with google_token_lock:
+        if not creds.valid:
+            await asyncio.to_thread(creds.refresh, Request())
+            atomic_write('token.json', creds.to_json())
+    
+    response = await http_client.request(
+        method, url, headers={'Authorization': f'Bearer {creds.token}'}, **kwargs
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+class RateLimiter:
+    # Leaky-bucket throttle on requests and tokens per minute. Callers queue on
+    # the lock and only sleep when a bucket would go negative.
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_request_capacity = float(rpm)
+        self.available_token_capacity = float(tpm)
+        self.last_update = time.monotonic()
+        self.throttled_until = 0.0
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def _refill_rate(self, now):
+        return 0.5 if now < self.throttled_until else 1.0
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        rate = self._refill_rate(now)
+        self.available_request_capacity = min(
+            self.rpm, self.available_request_capacity + self.rpm * rate * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.tpm, self.available_token_capacity + self.tpm * rate * elapsed / 60
+        )
+    
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        async with self.lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+                
+                rate = self._refill_rate(self.last_update)
+                wait = max(
+                    (1 - self.available_request_capacity) * 60 / (self.rpm * rate),
+                    (tokens - self.available_token_capacity) * 60 / (self.tpm * rate)
+                )
+                logger.debug(f"Rate limit reached, waiting {wait:.1f}s")
+                await asyncio.sleep(wait)
+    
+    def throttle(self, retry_after=None):
+        pause = retry_after if retry_after is not None else RATE_LIMIT_COOLDOWN
+        logger.warning(f"OpenAI rate limit hit, pausing requests for {pause:.1f}s")
+        now = time.monotonic()
+        self._refill()
+        # Our view of the capacity was wrong; start refilling from empty
+        self.available_request_capacity = 0.0
+        self.available_token_capacity = 0.0
+        self.paused_until = max(self.paused_until, now + pause)
+        self.throttled_until = self.paused_until + RATE_LIMIT_COOLDOWN
+
+def get_retry_after(error):
+    # Seconds the server asked us to wait, if it said
+    headers = error.response.headers
     try:
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        
-        logger.info("Sending request to OpenAI")
-        logger.debug(f"Email content: {email_content[:100]}...")
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+openai_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+WEEKDAYS = {name.lower() for name in calendar.day_name} | {name.lower() for name in calendar.day_abbr}
+# Year-less dates such as "March 14" are taken to be the next one coming up
+DATE_SETTINGS = {'REQUIRE_PARTS': ['day', 'month'], 'PREFER_DATES_FROM': 'future'}
+
+def parse_date(text):
+    parsed = dateparser.parse(text, languages=['en'], settings=DATE_SETTINGS)
+    return parsed.date() if parsed else None
+
+def trim_date_match(text, date):
+    # search_dates pulls neighbouring words into its matches ("of Friday the
+    # 3rd of May at The"); drop edge words as long as the rest is still the
+    # same date. Returns the (start, end) of the date within text
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    trimmed = True
+    while trimmed and len(words) > 1:
+        trimmed = False
+        for edge, rest in ((words[0], words[1:]), (words[-1], words[:-1])):
+            if text[edge[0]:edge[1]].lower().strip(',.') in WEEKDAYS:
+                continue
+            if parse_date(text[rest[0][0]:rest[-1][1]]) == date:
+                words = rest
+                trimmed = True
+                break
+    return words[0][0], words[-1][1]
+
+def prefilter_email(email_content):
+    # Dates and email addresses are found locally; only what is left of the
+    # body goes to OpenAI for the city and venue
+    matches = search_dates(email_content, languages=['en'], settings=DATE_SETTINGS) or []
+    
+    dates = []
+    spans = [match.span() for match in EMAIL_RE.finditer(email_content)]
+    today = datetime.now().date()
+    position = 0
+    for text, parsed in matches:
+        start = email_content.find(text, position)
+        if start == -1:
+            continue
+        position = start + len(text)
         
-        prompt = f"""Extract the following information from this email:
-        1. Email address
-        2. City (if mentioned, otherwise extract from venue location)
-        3. Venue name
-        4. Requested dates (if multiple dates are given, include all)
+        date = parse_date(text)
+        if date is None:
+            continue
+        trim_start, trim_end = trim_date_match(text, date)
+        spans.append((start + trim_start, start + trim_end))
         
-        Email content:
-        {email_content}
+        # Past dates are mentions of earlier shows, not requested dates
+        date_text = text[trim_start:trim_end]
+        if date >= today and date_text not in dates:
+            dates.append(date_text)
+    
+    # Cut by position so text that merely repeats a date ("9:30 Club") is kept
+    stripped_content = []
+    position = 0
+    for start, end in sorted(spans):
+        if start > position:
+            stripped_content.append(email_content[position:start])
+        position = max(position, end)
+    stripped_content.append(email_content[position:])
+    
+    return ' & '.join(dates), ''.join(stripped_content)
+
+# Output shape the model is constrained to: one result per email, by index
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "index": {"type": "integer"},
+                    "city": {"type": "string"},
+                    "venue": {"type": "string"}
+                },
+                "required": ["index", "city", "venue"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+# Fixed instructions sent as the system message. Keep this byte-identical across
+# requests: OpenAI only caches an identical prompt prefix of at least 1024 tokens,
+# so the rules and examples below are deliberately long enough to be cached on
+# their own, and only the emails in the user message are new input.
+EXTRACTION_INSTRUCTIONS = """You are a helpful assistant that extracts booking information from emails \
+a booking agent has sent to music venues.
+
+The user message contains one or more emails. Each email starts with its index in square \
+brackets on its own line, e.g. [0], followed by the email body. Email addresses and dates \
+have already been removed from the bodies, so sentences may contain gaps such as \
+"We'd love to hold  or ." Ignore those gaps; they are not part of any venue or city name.
+
+For every email, return one result with:
+- index: the email's index from the user message
+- venue: the name of the venue the agent is asking to book, exactly as written in the email \
+(e.g. "The Bowery Ballroom", not "Bowery Ballroom NYC")
+- city: the city the venue is in. Use the city named in the email; if none is named, use \
+the city the venue is located in. Give only the city name, without state or country.
+
+Rules for the venue:
+- Use the venue the agent is asking to book a date at. If an email mentions several venues, \
+for example a previous show or a venue the artist played with another act, pick the one \
+the hold or offer request is for.
+- Keep the venue's own spelling, capitalisation and punctuation, including a leading "The" \
+when the email uses it. Do not expand abbreviations or add the city to the name.
+- If the request is for a specific room inside a larger building (e.g. "the Parish room at \
+House of Blues"), return the name of the building the agent is booking, as written \
+("House of Blues").
+- Festivals, fairs and private events count as venues; return the event name as written.
+- Do not return the artist, promoter, booker or agency name as the venue.
+
+Rules for the city:
+- A city named in the email for the requested show always wins over your own knowledge.
+- Otherwise use the city the venue is located in, if you know it with confidence. Venues \
+with the same name exist in several cities; when you are not sure which one is meant, \
+return an empty string rather than guess.
+- Use the common English name of the city ("New York", not "NYC" or "Brooklyn"; \
+"Washington", not "DC"). Neighbourhoods and boroughs map to their city.
+- Never return a state, province, region or country on its own.
+
+General rules:
+- Return exactly one result per email, in index order, and never merge or skip emails.
+- Treat every email on its own; never copy a venue or city from one email to another.
+- Ignore venues, cities and names that only appear in signatures, quoted replies or \
+forwarded messages.
+- If the venue or city cannot be determined, return an empty string for it.
+- Follow-ups and reminders about an earlier request still name a venue; extract it the \
+same way as a first request.
+- Emails may be short, informal, written in lowercase or contain typos. Read them the way \
+a booking assistant would and correct only obvious typos in well-known venue or city \
+names; otherwise keep the text as written.
+- Emails that are not booking requests at all (thank-you notes, invoices, travel details) \
+still get a result; return empty strings if no requested venue can be found.
+- Return only the fields listed above, with no explanations, notes or extra keys.
+
+Example user message:
+[0]
+Hi Sam,
+
+I'm reaching out on behalf of The Midnight Owls about a headline show at the 9:30 Club. \
+We'd love to hold , or  if either works.
+
+Best,
+Alex
+
+[1]
+Hey Jordan,
+
+Following up on my note from last week. The Paper Lanterns would still love to play \
+Mercury Lounge in New York on their fall run. They sold out the Bowery Ballroom on the \
+last tour, so we're confident about a Friday or Saturday. Could you pencil in  for us?
+
+Thanks,
+Alex
+Riverbend Artists | Nashville, TN
+
+[2]
+Hi team,
+
+Checking availability for the Parish room at House of Blues in Austin for Kite Season. \
+Also happy to look at  if that's easier on your end.
+
+Cheers,
+Alex
+
+[3]
+Hello,
+
+Is there any chance of a hold at The Grand on ? Happy to send over numbers from the \
+spring tour.
+
+Alex
+
+[4]
+hi!! thanks so much for having the band last night, everyone had a blast. settlement \
+sheet is attached and the merch count is in the second tab. talk soon!
+
+alex
+
+[5]
+Hi Morgan,
+
+Quick one: we're routing the west coast leg for Static Bloom and would love a date at \
+the Crystal Ballroom in Portland, ideally , with a fallback of . We played Doug Fir \
+Lounge last time and it was packed, so we think the bigger room makes sense now.
+
+Best,
+Alex
+
+Example result:
+{"results": [\
+{"index": 0, "venue": "9:30 Club", "city": "Washington"}, \
+{"index": 1, "venue": "Mercury Lounge", "city": "New York"}, \
+{"index": 2, "venue": "House of Blues", "city": "Austin"}, \
+{"index": 3, "venue": "The Grand", "city": ""}, \
+{"index": 4, "venue": "", "city": ""}, \
+{"index": 5, "venue": "Crystal Ballroom", "city": "Portland"}]}
+
+Why: [0] names no city, so it comes from the 9:30 Club's location. [1] is a follow-up \
+for Mercury Lounge; the Bowery Ballroom is a past show and Nashville is only in the \
+signature. [2] books a room inside House of Blues, and the email names the city. [3] could \
+be one of many venues called The Grand, so the city is left empty. [4] is a thank-you \
+note after a show, not a booking request, so both fields are empty. [5] asks for the \
+Crystal Ballroom, whose city is stated; Doug Fir Lounge is only the previous show."""
+
+def build_extraction_request(email_contents):
+    # Only the emails vary between requests
+    emails = '\n\n'.join(
+        f"[{index}]\n{email_content}" for index, email_content in enumerate(email_contents)
+    )
+    
+    return {
+        "model": "gpt-4o-mini",  # Structured outputs need gpt-4o-mini or newer
+        "messages": [
+            {"role": "system", "content": EXTRACTION_INSTRUCTIONS},
+            {"role": "user", "content": emails}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "email_extraction",
+                "schema": EXTRACTION_SCHEMA,
+                "strict": True
+            }
+        },
+        "max_tokens": OPENAI_MAX_TOKENS_PER_EMAIL * len(email_contents)
+    }
+
+def parse_extraction_response(content, count):
+    results = {result['index']: result for result in orjson.loads(content)['results']}
+    missing = [index for index in range(count) if index not in results]
+    if missing:
+        raise ValueError(f"OpenAI response is missing results for emails {missing}")
+    return [results[index] for index in range(count)]
+
+async def extract_email_data(email_contents):
+    try:
+        logger.info(f"Sending request to OpenAI for {len(email_contents)} email(s)")
+        for email_content in email_contents:
+            logger.debug(f"Email content: {email_content[:100]}...")
         
-        Return the information in JSON format with keys: email, city, venue, dates
-        Note: If there are multiple date ranges, combine them into a single string separated by ' & '"""
+        request = build_extraction_request(email_contents)
+        estimated_tokens = sum(len(m['content']) for m in request['messages']) // 4 + request['max_tokens']
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Changed from gpt-4o-mini which was incorrect
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that extracts specific information from emails."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        async with openai_semaphore:
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                await openai_limiter.acquire(estimated_tokens)
+                try:
+                    # The limiter handles 429s; SDK retries would back off first
+                    response = await openai_client.with_options(max_retries=0).chat.completions.create(**request)
+                    break
+                except RateLimitError as e:
+                    openai_limiter.throttle(get_retry_after(e))
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
         
         logger.info("Received response from OpenAI")
-        logger.debug(f"OpenAI response: {response.choices[0].message.content}")
+        message = response.choices[0].message
+        logger.debug(f"OpenAI response: {message.content}")
         
-        parsed_response = json.loads(response.choices[0].message.content)
-        return parsed_response
+        if message.refusal:
+            raise ValueError(f"OpenAI refused to extract the emails: {message.refusal}")
+        
+        return parse_extraction_response(message.content, len(email_contents))
         
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse OpenAI response: {e}")
-        logger.error(f"Raw response: {response.choices[0].message.content}")
-        raise
     except Exception as e:
         logger.error(f"Error in extract_email_data: {str(e)}")
         raise
 
-def update_spreadsheet(service, spreadsheet_id, values):
+def group_emails(email_contents):
+    return [
+        email_contents[start:start + EXTRACTION_GROUP_SIZE]
+        for start in range(0, len(email_contents), EXTRACTION_GROUP_SIZE)
+    ]
+
+async def extract_email_data_grouped(email_contents):
+    # Returns one result (or the exception that prevented it) per email
+    groups = group_emails(email_contents)
+    group_results = await asyncio.gather(*[
+        extract_email_data(group) for group in groups
+    ], return_exceptions=True)
+    
+    results = []
+    for group, group_result in zip(groups, group_results):
+        if (isinstance(group_result, Exception) and not isinstance(group_result, RateLimitError)
+                and len(group) > 1):
+            # One bad email must not fail its whole group; retry them one per request.
+            # Rate limiting is not the emails' fault, so those groups are queued as they are
+            logger.warning(f"Extraction failed for a group of {len(group)} emails, retrying individually")
+            single_results = await asyncio.gather(*[
+                extract_email_data([email_content]) for email_content in group
+            ], return_exceptions=True)
+            group_result = [
+                result if isinstance(result, Exception) else result[0]
+                for result in single_results
+            ]
+        elif isinstance(group_result, Exception):
+            group_result = [group_result]
+        results.extend(group_result)
+    
+    return results
+
+async def extract_email_data_batch(email_contents):
     try:
-        # First, get all values to find the next empty row
-        range_name = 'Hold Grid!A:F'
-        result = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range=range_name
-        ).execute()
-        
-        # Find the next empty row by checking email column (A)
-        current_values = result.get('values', [])
-        next_row = 1  # Start at 1 to account for header row
-        
-        for row in current_values:
-            # Check if the email column (first column) has a value
-            if row and row[0].strip():  # Check if first column (email) is non-empty
-                next_row += 1
-            else:
-                break
+        # One chat completion request per group of emails, matched back up by custom_id
+        groups = group_emails(email_contents)
+        batch_input = b''.join(
+            orjson.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_extraction_request(group)
+            }, option=orjson.OPT_APPEND_NEWLINE)
+            for index, group in enumerate(groups)
+        )
+        
+        input_file = await openai_client.files.create(
+            file=('email_extraction.jsonl', batch_input),
+            purpose='batch'
+        )
+        batch = await openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        logger.info(f"Submitted OpenAI batch {batch.id} with {len(email_contents)} email(s)")
+        
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await openai_client.batches.retrieve(batch.id)
+            logger.info(f"OpenAI batch {batch.id} is {batch.status}")
         
-        logger.info(f"Inserting data at row {next_row}")
+        if batch.status != 'completed':
+            raise RuntimeError(f"OpenAI batch {batch.id} ended with status {batch.status}")
         
-        # Update specific range using the next empty row
-        update_range = f'Hold Grid!A{next_row}:E{next_row}'
+        results = [None] * len(groups)
+        if batch.output_file_id:
+            output = await openai_client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                row = orjson.loads(line)
+                response = row.get('response')
+                if row.get('error') or not response or response['status_code'] != 200:
+                    logger.error(f"Batch request {row['custom_id']} failed: {row.get('error')}")
+                    continue
+                index = int(row['custom_id'])
+                try:
+                    results[index] = parse_extraction_response(
+                        response['body']['choices'][0]['message']['content'], len(groups[index])
+                    )
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.error(f"Failed to parse batch response {row['custom_id']}: {e}")
+        
+        # Anything the batch could not answer goes through the regular path,
+        # with per-email results so one failure does not discard the rest
+        missing = [index for index, result in enumerate(results) if result is None]
+        retried = await extract_email_data_grouped(
+            [email_content for index in missing for email_content in groups[index]]
+        )
+        for index in missing:
+            results[index], retried = retried[:len(groups[index])], retried[len(groups[index]):]
+        
+        return [data for group_results in results for data in group_results]
+        
+    except Exception as e:
+        logger.error(f"Error in extract_email_data_batch: {str(e)}")
+        raise
+
+async def update_spreadsheet(spreadsheet_id, values):
+    try:
+        # Sheets finds the next empty row itself and inserts the data there
         body = {
             'values': values
         }
         
-        service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=update_range,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
+        range_name = urllib.parse.quote('Hold Grid!A:E')
+        result = await google_request(
+            'POST',
+            f'{SHEETS_API}/{spreadsheet_id}/values/{range_name}:append',
+            params={
+                'valueInputOption': 'USER_ENTERED',
+                'insertDataOption': 'INSERT_ROWS'
+            },
+            json=body
+        )
         
+        logger.info(f"Inserted data at {result['updates']['updatedRange']}")
         logger.info("Successfully updated spreadsheet")
         
     except Exception as e:
         logger.error(f"Error updating spreadsheet: {str(e)}")
         raise
 
+class RowBuffer:
+    # Collects spreadsheet rows so several emails share one Sheets call.
+    # Checkpoints (saving the last processed ID) only run once the rows queued
+    # before them are written, so a crash never skips unwritten emails.
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.rows = []
+        self.checkpoints = []
+        self.last_flush = time.monotonic()
+        # Failed writes back off exponentially, like failed emails
+        self.failed_flushes = 0
+        self.next_flush_at = 0.0
+        self.lock = asyncio.Lock()
+    
+    def add(self, rows):
+        self.rows.extend(rows)
+    
+    def add_checkpoint(self, checkpoint):
+        self.checkpoints.append(checkpoint)
+    
+    def can_flush(self):
+        return time.monotonic() >= self.next_flush_at
+    
+    def due(self):
+        return self.can_flush() and (
+            len(self.rows) >= ROW_BUFFER_SIZE
+            or time.monotonic() - self.last_flush > ROW_FLUSH_INTERVAL
+        )
+    
+    def full(self):
+        return len(self.rows) >= MAX_BUFFERED_ROWS
+    
+    async def flush(self):
+        async with self.lock:
+            # Rows and checkpoints added while the write is in flight wait for the next flush
+            rows, checkpoints = self.rows[:], self.checkpoints[:]
+            if rows:
+                logger.info(f"Writing {len(rows)} row(s) to spreadsheet")
+                try:
+                    await update_spreadsheet(self.spreadsheet_id, rows)
+                except Exception:
+                    self.failed_flushes += 1
+                    delay = min(MAX_RETRY_DELAY, ROW_FLUSH_INTERVAL * 2 ** self.failed_flushes)
+                    self.next_flush_at = time.monotonic() + delay
+                    logger.warning(f"Spreadsheet write failed {self.failed_flushes} time(s), next attempt in {delay}s")
+                    raise
+                self.failed_flushes = 0
+                self.next_flush_at = 0.0
+                del self.rows[:len(rows)]
+            for checkpoint in checkpoints:
+                checkpoint()
+            del self.checkpoints[:len(checkpoints)]
+            self.last_flush = time.monotonic()
+
+async def flush_periodically(row_buffer):
+    while True:
+        await asyncio.sleep(ROW_FLUSH_INTERVAL)
+        try:
+            if (row_buffer.rows or row_buffer.checkpoints) and row_buffer.can_flush():
+                await row_buffer.flush()
+        except Exception as e:
+            logger.error(f"Error flushing spreadsheet rows: {str(e)}", exc_info=True)
+
+@functools.lru_cache(maxsize=None)
+def get_failure_db():
+    db = sqlite3.connect('failures.db')
+    db.execute('''CREATE TABLE IF NOT EXISTS failures (
+        msg_id TEXT PRIMARY KEY,
+        attempts INTEGER NOT NULL,
+        next_retry REAL,  -- NULL once the email has been given up on
+        last_error TEXT,
+        in_flight INTEGER NOT NULL DEFAULT 0  -- retried, its row waits in the RowBuffer
+    )''')
+    columns = [row[1] for row in db.execute('PRAGMA table_info(failures)')]
+    if 'in_flight' not in columns:
+        db.execute('ALTER TABLE failures ADD COLUMN in_flight INTEGER NOT NULL DEFAULT 0')
+    # Buffered rows do not survive a restart, so those emails are due again
+    with db:
+        db.execute('UPDATE failures SET in_flight = 0')
+    return db
+
+def record_failure(message_id, error, permanent=False):
+    # Failed emails are set aside so the rest of the mailbox keeps moving
+    db = get_failure_db()
+    row = db.execute('SELECT attempts FROM failures WHERE msg_id = ?', (message_id,)).fetchone()
+    attempts = (row[0] if row else 0) + 1
+    
+    if permanent or attempts >= MAX_RETRY_ATTEMPTS:
+        next_retry = None
+        logger.error(f"Giving up on email {message_id} after {attempts} attempt(s): {str(error)}")
+    else:
+        delay = min(MAX_RETRY_DELAY, 2 ** attempts)
+        next_retry = time.time() + delay
+        logger.error(f"Failed to process email {message_id} (attempt {attempts}), retrying in {delay}s: {str(error)}")
+    
+    with db:
+        db.execute(
+            'INSERT OR REPLACE INTO failures (msg_id, attempts, next_retry, last_error) '
+            'VALUES (?, ?, ?, ?)',
+            (message_id, attempts, next_retry, str(error))
+        )
+
+def mark_failures_in_flight(message_ids):
+    # Retried emails whose rows are buffered must not be picked up again
+    # while the spreadsheet write is pending
+    db = get_failure_db()
+    with db:
+        db.executemany('UPDATE failures SET in_flight = 1 WHERE msg_id = ?',
+                       [(message_id,) for message_id in message_ids])
+
+def clear_failures(message_ids):
+    db = get_failure_db()
+    with db:
+        db.executemany('DELETE FROM failures WHERE msg_id = ?', [(message_id,) for message_id in message_ids])
+
+def get_due_failures():
+    return [
+        row[0] for row in get_failure_db().execute(
+            'SELECT msg_id FROM failures '
+            'WHERE next_retry IS NOT NULL AND next_retry <= ? AND in_flight = 0 '
+            'ORDER BY next_retry', (time.time(),)
+        )
+    ]
+
+async def retry_failures(row_buffer):
+    while True:
+        await asyncio.sleep(RETRY_CHECK_INTERVAL)
+        try:
+            if row_buffer.full():
+                continue
+            message_ids = get_due_failures()
+            if message_ids:
+                logger.info(f"Retrying {len(message_ids)} failed email(s)")
+                # Retries never wait on the Batch API's up-to-24h turnaround
+                await process_messages(row_buffer, message_ids, use_batch_api=False)
+        except Exception as e:
+            logger.error(f"Error retrying failed emails: {str(e)}", exc_info=True)
+
+# In-memory copies of the saved IDs: each file is read once and only
+# rewritten when its ID changes
+saved_ids = {}
+
+def load_saved_id(path):
+    if path not in saved_ids:
+        try:
+            with open(path, 'r') as f:
+                saved_ids[path] = f.read().strip()
+        except FileNotFoundError:
+            saved_ids[path] = None
+    return saved_ids[path]
+
+def save_id(path, value):
+    value = str(value)
+    if saved_ids.get(path) == value:
+        return
+    atomic_write(path, value)
+    saved_ids[path] = value
+
 def get_last_processed_id():
-    try:
-        with open('last_processed.txt', 'r') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return None
+    return load_saved_id('last_processed.txt')
 
 def save_last_processed_id(message_id):
-    with open('last_processed.txt', 'w') as f:
-        f.write(message_id)
+    save_id('last_processed.txt', message_id)
+
+def get_last_history_id():
+    return load_saved_id('last_history_id.txt')
+
+def save_last_history_id(history_id):
+    save_id('last_history_id.txt', history_id)
+
+async def start_watch(topic_name):
+    response = await google_request(
+        'POST',
+        f'{GMAIL_API}/watch',
+        json={
+            'labelIds': ['SENT'],
+            'labelFilterBehavior': 'INCLUDE',
+            'topicName': topic_name
+        }
+    )
+    logger.info(f"Gmail watch active until {datetime.fromtimestamp(int(response['expiration']) / 1000)}")
+    return response
+
+async def get_new_message_ids(start_history_id):
+    message_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    
+    while True:
+        params = {
+            'startHistoryId': start_history_id,
+            'historyTypes': 'messageAdded',
+            'labelId': 'SENT'
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        results = await google_request('GET', f'{GMAIL_API}/history', params=params)
+        
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_id = added['message']['id']
+                if message_id not in message_ids:
+                    message_ids.append(message_id)
+        
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    return message_ids, latest_history_id
+
+class PubSubHandler(BaseHTTPRequestHandler):
+    # Set by start_webhook_server; the asyncio queue receives the historyId
+    # of every notification and is fed from the server thread via the loop
+    loop = None
+    notifications = None
+    token = None
+    
+    def do_POST(self):
+        # The push subscription URL carries a shared secret as ?token=...
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            authorized = hmac.compare_digest(
+                query.get('token', [''])[0].encode('utf-8'), self.token.encode('utf-8')
+            )
+        except Exception:
+            authorized = False
+        
+        if not authorized:
+            logger.warning(f"Rejected Pub/Sub push from {self.client_address[0]}: invalid token")
+            self.send_response(403)
+            self.end_headers()
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            envelope = orjson.loads(self.rfile.read(length))
+            data = orjson.loads(base64.b64decode(envelope['message']['data']))
+            logger.info(f"Received Gmail notification for {data.get('emailAddress')}")
+            # The notification only wakes the processor; the history is always
+            # read from our own persisted historyId, never from the payload
+            self.loop.call_soon_threadsafe(self.notifications.put_nowait, data.get('historyId'))
+        except Exception as e:
+            # Acknowledge anyway so Pub/Sub does not redeliver a malformed message
+            logger.error(f"Invalid Pub/Sub push message: {str(e)}")
+        
+        self.send_response(204)
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook: {format % args}")
 
-def monitor_emails():
+def start_webhook_server(host, port, token, notifications):
+    PubSubHandler.loop = asyncio.get_running_loop()
+    PubSubHandler.notifications = notifications
+    PubSubHandler.token = token
+    server = ThreadingHTTPServer((host, port), PubSubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Listening for Pub/Sub push notifications on {host}:{port}")
+    return server
+
+async def fetch_messages(message_ids):
+    semaphore = asyncio.Semaphore(GMAIL_CONCURRENCY)
+    
+    async def fetch_message(message_id):
+        async with semaphore:
+            return await google_request(
+                'GET', f'{GMAIL_API}/messages/{message_id}', params={'format': 'raw'}
+            )
+    
+    # Requests share one HTTP/2 connection, so fetching them concurrently
+    # replaces the Gmail batch endpoint
+    messages = await asyncio.gather(
+        *[fetch_message(message_id) for message_id in message_ids],
+        return_exceptions=True
+    )
+    return list(zip(message_ids, messages))
+
+def parse_message(message_id, message):
+    logger.info(f"Processing new email {message_id}")
+    
+    mime_message = email.message_from_bytes(
+        base64.urlsafe_b64decode(message['raw']), policy=email.policy.default
+    )
+    
+    # Get recipient email from headers
+    to_email = mime_message['To']
+    
+    # Extract email body, preferring plain text at any depth of a multipart message
+    body = mime_message.get_body(preferencelist=('plain', 'html'))
+    email_content = body.get_content() if body is not None else ''
+    
+    if not to_email:
+        # No To header (e.g. Bcc only); fall back to the first address in the body
+        match = EMAIL_RE.search(email_content)
+        to_email = match.group(0) if match else ''
+    logger.info(f"Email sent to: {to_email}")
+    
+    return str(to_email), email_content
+
+def build_row(to_email, extracted_data):
+    # Prepare data for spreadsheet (removed Date Confirmed)
+    return [[
+        to_email,           # Email column (now using recipient's email)
+        extracted_data['city'],   # City column
+        extracted_data['venue'],  # Venue column
+        extracted_data['dates'],  # Dates requested column
+        'CONTACTED'               # Status column
+    ]]
+
+def prepare_message(message_id, message):
+    to_email, email_content = parse_message(message_id, message)
+    dates, stripped_content = prefilter_email(email_content)
+    return to_email, dates, stripped_content
+
+async def process_messages(row_buffer, message_ids, use_batch_api=False):
+    # Emails that fail at any step are recorded for a later retry instead of
+    # failing the whole batch
+    if not message_ids:
+        return
+    
+    logger.info(f"Fetching {len(message_ids)} new email(s)")
+    messages = await fetch_messages(message_ids)
+    
+    prepared = []
+    for message_id, message in messages:
+        if isinstance(message, Exception):
+            # A message Gmail rejects (e.g. deleted, 404) will not come back on retry;
+            # auth and rate-limit errors are not specific to the message
+            permanent = (isinstance(message, httpx.HTTPStatusError)
+                         and 400 <= message.response.status_code < 500
+                         and message.response.status_code not in (401, 403, 429))
+            record_failure(message_id, message, permanent=permanent)
+            continue
+        try:
+            prepared.append((message_id, *await asyncio.to_thread(prepare_message, message_id, message)))
+        except Exception as e:
+            record_failure(message_id, e)
+    
+    # Extract data using AI, several emails per request and all requests concurrently
+    email_contents = [stripped_content for _, _, _, stripped_content in prepared]
+    if use_batch_api and len(email_contents) >= BATCH_API_THRESHOLD:
+        try:
+            results = await extract_email_data_batch(email_contents)
+        except Exception as e:
+            results = [e] * len(email_contents)
+    else:
+        results = await extract_email_data_grouped(email_contents)
+    
+    # Queue spreadsheet rows in message order
+    processed_ids = []
+    for (message_id, to_email, dates, _), extracted_data in zip(prepared, results):
+        if isinstance(extracted_data, Exception):
+            record_failure(message_id, extracted_data)
+            continue
+        extracted_data = {**extracted_data, 'email': to_email, 'dates': dates}
+        row_buffer.add(build_row(to_email, extracted_data))
+        processed_ids.append(message_id)
+    
+    # Emails that were being retried are done once their rows are written
+    if processed_ids:
+        mark_failures_in_flight(processed_ids)
+        row_buffer.add_checkpoint(functools.partial(clear_failures, processed_ids))
+    
+    if row_buffer.due():
+        try:
+            await row_buffer.flush()
+        except Exception as e:
+            # The rows stay buffered for the background flusher; callers must
+            # still advance past these emails or they would be buffered twice
+            logger.error(f"Error flushing spreadsheet rows, will retry: {str(e)}", exc_info=True)
+    
+    logger.info(f"Processed {len(processed_ids)} of {len(message_ids)} email(s)")
+
+async def poll_emails(row_buffer):
+    last_message_id = get_last_processed_id()
+    logger.info(f"Last processed message ID: {last_message_id}")
+    
+    while True:
+        try:
+            if row_buffer.full():
+                logger.warning("Spreadsheet writes are failing, waiting before fetching more emails")
+                await asyncio.sleep(POLL_INTERVAL + random.uniform(0, POLL_JITTER))
+                continue
+            
+            results = await google_request(
+                'GET',
+                f'{GMAIL_API}/messages',
+                params={'labelIds': 'SENT', 'maxResults': GMAIL_PAGE_SIZE}
+            )
+            
+            messages = results.get('messages', [])
+            
+            # Messages are listed newest first; catch up on everything sent
+            # since the last processed one (or just the newest on first run)
+            new_message_ids = []
+            for message in messages:
+                if message['id'] == last_message_id:
+                    break
+                new_message_ids.append(message['id'])
+                if last_message_id is None:
+                    break
+            
+            if new_message_ids:
+                await process_messages(row_buffer, new_message_ids[::-1])
+                
+                # Save the ID once the rows are written
+                last_message_id = new_message_ids[0]
+                row_buffer.add_checkpoint(functools.partial(save_last_processed_id, last_message_id))
+                
+            await asyncio.sleep(POLL_INTERVAL + random.uniform(0, POLL_JITTER))
+            
+        except Exception as e:
+            logger.error(f"Error in monitor_emails loop: {str(e)}", exc_info=True)
+            await asyncio.sleep(POLL_INTERVAL + random.uniform(0, POLL_JITTER))
+
+async def watch_emails(row_buffer, topic_name, host, port, token):
+    notifications = asyncio.Queue()
+    start_webhook_server(host, port, token, notifications)
+    
+    watch = await start_watch(topic_name)
+    watch_expiration = int(watch['expiration']) / 1000
+    
+    history_id = get_last_history_id()
+    if history_id is None:
+        history_id = watch['historyId']
+        save_last_history_id(history_id)
+    logger.info(f"Last processed history ID: {history_id}")
+    
+    # After an error, re-check history shortly instead of waiting for the next notification
+    recheck = False
+    
+    while True:
+        try:
+            if not recheck:
+                try:
+                    await asyncio.wait_for(notifications.get(), NOTIFICATION_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            recheck = False
+            
+            # One history read covers every notification received so far
+            while not notifications.empty():
+                notifications.get_nowait()
+            
+            if time.time() > watch_expiration - WATCH_RENEW_MARGIN:
+                watch = await start_watch(topic_name)
+                watch_expiration = int(watch['expiration']) / 1000
+            
+            if row_buffer.full():
+                logger.warning("Spreadsheet writes are failing, waiting before fetching more emails")
+                recheck = True
+                await asyncio.sleep(POLL_INTERVAL + random.uniform(0, POLL_JITTER))
+                continue
+            
+            try:
+                message_ids, latest_history_id = await get_new_message_ids(history_id)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                # The stored historyId is too old for Gmail to replay; restart from now
+                logger.warning(f"History ID {history_id} expired, resetting to current mailbox state")
+                watch = await start_watch(topic_name)
+                history_id = watch['historyId']
+                save_last_history_id(history_id)
+                continue
+            
+            await process_messages(row_buffer, message_ids)
+            
+            # Save the history ID once the rows are written
+            history_id = latest_history_id
+            row_buffer.add_checkpoint(functools.partial(save_last_history_id, history_id))
+            
+        except Exception as e:
+            logger.error(f"Error in monitor_emails loop: {str(e)}", exc_info=True)
+            recheck = True
+            await asyncio.sleep(POLL_INTERVAL + random.uniform(0, POLL_JITTER))
+
+async def reprocess_emails(after):
+    # Authorize up front, before any requests are in flight
+    get_google_credentials()
+    
+    SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
+    logger.info(f"Reprocessing emails sent after {after} into spreadsheet: {SPREADSHEET_ID}")
+    
+    message_ids = []
+    page_token = None
+    while True:
+        params = {'labelIds': 'SENT', 'q': f'after:{after}', 'maxResults': 500}
+        if page_token:
+            params['pageToken'] = page_token
+        results = await google_request('GET', f'{GMAIL_API}/messages', params=params)
+        message_ids.extend(message['id'] for message in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    # Oldest first, like the live monitor
+    row_buffer = RowBuffer(SPREADSHEET_ID)
     try:
-        creds = get_google_credentials()
-        gmail_service = build('gmail', 'v1', credentials=creds)
-        sheets_service = build('sheets', 'v4', credentials=creds)
+        # Only reprocessing runs can afford the Batch API's up-to-24h turnaround
+        await process_messages(row_buffer, message_ids[::-1], use_batch_api=True)
+    finally:
+        await row_buffer.flush()
+
+async def monitor_emails():
+    try:
+        # Authorize up front, before any requests are in flight
+        get_google_credentials()
         
         SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
         logger.info(f"Starting email monitoring for spreadsheet: {SPREADSHEET_ID}")
         
-        last_message_id = get_last_processed_id()
-        logger.info(f"Last processed message ID: {last_message_id}")
+        row_buffer = RowBuffer(SPREADSHEET_ID)
+        flusher = asyncio.create_task(flush_periodically(row_buffer))
+        retrier = asyncio.create_task(retry_failures(row_buffer))
         
-        while True:
-            try:
-                results = gmail_service.users().messages().list(
-                    userId='me',
-                    labelIds=['SENT'],
-                    maxResults=1
-                ).execute()
-                
-                messages = results.get('messages', [])
-                
-                if messages and (last_message_id != messages[0]['id']):
-                    last_message_id = messages[0]['id']
-                    
-                    logger.info("Processing new email")
-                    
-                    message = gmail_service.users().messages().get(
-                        userId='me',
-                        id=last_message_id,
-                        format='full'
-                    ).execute()
-                    
-                    # Get recipient email from headers
-                    headers = message['payload']['headers']
-                    to_email = next(
-                        header['value'] for header in headers 
-                        if header['name'].lower() == 'to'
-                    )
-                    logger.info(f"Email sent to: {to_email}")
-                    
-                    # Extract email body
-                    if 'data' in message['payload']['body']:
-                        email_content = base64.urlsafe_b64decode(
-                            message['payload']['body']['data']
-                        ).decode('utf-8')
-                    else:
-                        # Handle multipart messages
-                        parts = message['payload']['parts']
-                        email_content = base64.urlsafe_b64decode(
-                            parts[0]['body']['data']
-                        ).decode('utf-8')
-                    
-                    # Extract data using AI
-                    extracted_data = extract_email_data(email_content)
-                    
-                    # Prepare data for spreadsheet (removed Date Confirmed)
-                    row_data = [[
-                        to_email,           # Email column (now using recipient's email)
-                        extracted_data['city'],   # City column
-                        extracted_data['venue'],  # Venue column
-                        extracted_data['dates'],  # Dates requested column
-                        'CONTACTED'               # Status column
-                    ]]
-                    
-                    # Update spreadsheet
-                    update_spreadsheet(sheets_service, SPREADSHEET_ID, row_data)
-                    
-                    logger.info("Successfully processed email")
-                    
-                    # Save the ID after successful processing
-                    save_last_processed_id(last_message_id)
-                    
-                time.sleep(60)
-                
-            except Exception as e:
-                logger.error(f"Error in monitor_emails loop: {str(e)}", exc_info=True)
-                time.sleep(60)
+        # Stop on SIGTERM the same way as on Ctrl+C: cancel the monitor so the
+        # buffered rows are flushed below
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel
+            )
+        except NotImplementedError:
+            pass  # Not supported on Windows
+        
+        try:
+            # Push notifications need a Pub/Sub topic the Gmail API can publish to;
+            # without one, fall back to polling the SENT label
+            PUBSUB_TOPIC = os.getenv('PUBSUB_TOPIC')
+            if PUBSUB_TOPIC:
+                WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+                if not WEBHOOK_TOKEN:
+                    raise ValueError("WEBHOOK_TOKEN must be set to receive Pub/Sub push notifications")
+                # Listen locally by default; a TLS-terminating proxy forwards the pushes
+                WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+                WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+                await watch_emails(row_buffer, PUBSUB_TOPIC, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_TOKEN)
+            else:
+                await poll_emails(row_buffer)
+        finally:
+            # Write whatever is still buffered before exiting
+            flusher.cancel()
+            retrier.cancel()
+            await row_buffer.flush()
                 
+    except asyncio.CancelledError:
+        logger.info("Email monitoring stopped")
     except Exception as e:
         logger.error(f"Fatal error in monitor_emails: {str(e)}", exc_info=True)
         raise
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Route sent booking emails into the Hold Grid spreadsheet")
+    parser.add_argument('--reprocess-after', metavar='YYYY/MM/DD',
+                        help="process every email sent after this date once, then exit")
+    args = parser.parse_args()
+    
     logger.info("Starting application")
     try:
-        monitor_emails()
+        if args.reprocess_after:
+            asyncio.run(reprocess_emails(args.reprocess_after))
+        else:
+            asyncio.run(monitor_emails())
     except Exception as e:
         logger.error("Application crashed", exc_info=True) 
\ No newline at end of file
@@ -0,0 +1,40 @@
+import os
+
+# app builds its OpenAI client on import
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from app import prefilter_email
+
+
+def test_dates_are_trimmed_and_venue_names_kept():
+    dates, stripped = prefilter_email("We'd love to book March 14 & March 15 at the 9:30 Club in DC.")
+    assert dates == 'March 14 & March 15'
+    assert '9:30 Club' in stripped
+    assert 'March' not in stripped
+
+
+def test_neighbouring_words_are_not_dates():
+    dates, stripped = prefilter_email("How about 10/12 & 10/14 at The Grand, or Nov 2nd at Metro?")
+    assert dates == '10/12 & 10/14 & Nov 2nd'
+    assert 'How about' in stripped
+    assert 'at The Grand' in stripped
+    assert 'at Metro' in stripped
+
+
+def test_weekday_is_kept_with_its_date():
+    dates, stripped = prefilter_email("Any chance of Friday the 3rd of May at The Grand in Boston?")
+    assert dates == 'Friday the 3rd of May'
+    assert stripped == 'Any chance of  at The Grand in Boston?'
+
+
+def test_past_dates_are_not_requested_dates():
+    dates, stripped = prefilter_email("We played on 2024-05-01 at the Roxy, could we come back on June 5th 2099?")
+    assert dates == 'June 5th 2099'
+    assert '2024' not in stripped
+    assert 'the Roxy' in stripped
+
+
+def test_email_addresses_are_removed():
+    dates, stripped = prefilter_email("Reach me at booker@venue.com about the Roxy.")
+    assert dates == ''
+    assert stripped == 'Reach me at  about the Roxy.'